@@ -1,11 +1,28 @@
+from asyncio import gather
 from datetime import date
-from html import unescape
-from re import search
+from functools import lru_cache
 from time import strftime
-from typing import Union
+from typing import List, Tuple, Union
 
+from lxml import html as lxml_html
 from requests import Response, Session
+from requests.adapters import HTTPAdapter
 
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+_AJAX_URL = 'https://lernplattform.mebis.bayern.de/lib/ajax/service.php'
+_SURVEY_URL = 'https://lernplattform.mebis.bayern.de/mod/choice/view.php'
+_AJAX_ERROR = ('The ajax request failed. Check for spelling errors or take a'
+               ' look at the docs.')
 
 debug = False
 """Flag indicating whether varbose messages should be used.
@@ -20,8 +37,9 @@ def set_debug(val: bool):
     Args:
         val (bool, required): The value to set 'debug' to.
     """
-    global debug
+    global debug, log
     debug = val
+    log = _real_log if val else _noop_log
 
 
 class UserSession():
@@ -33,6 +51,7 @@ class UserSession():
 
     Raises:
         LoginError: If the login failed.
+        ActionFailedError: If the login pages could not be read.
 
     Attributes:
         sesskey (str): The session key (one of them at least).
@@ -47,31 +66,43 @@ class UserSession():
             log(f'Logging in user "{user}".')
             log('Creating session...')
         self._session = Session()
-        if debug:
-            log('Getting session tokens.')
+        # keep connections to both mebis hosts alive and pooled
+        self._session.mount('https://', HTTPAdapter(pool_connections=4,
+                                                    pool_maxsize=32))
+        log('Getting session tokens.')
         # fill up cookie jar
         r = self._session.get('https://lernplattform.mebis.bayern.de')
         # sign in to get session tokens
+        tree = lxml_html.fromstring(r.content)
         nexturl = 'https://idp.mebis.bayern.de'\
-            + search(r'(?<=action=\").*?(?=\")', r.text).group(0)
+            + _xpath_first(tree, '//form/@action')
         r = self._session.post(nexturl, data={'j_username': user,
                                               'j_password': pwd,
                                               '_eventId_proceed': ''})
-        if 'form-error' in r.text:
-            raise LoginError(self._user)
+        if b'form-error' in r.content:
+            raise LoginError(user)
         # complete full signin
-        nexturl = unescape(search(r'(?<=action=\").*?(?=\")', r.text).group(0))
-        rs = unescape(search(r'(?<=name=\"RelayState\" value=\").*?(?=\")',
-                             r.text).group(0))
-        saml = search(r'(?<=name=\"SAMLResponse\" value=\").*?(?=\")',
-                      r.text).group(0)
+        tree = lxml_html.fromstring(r.content)
+        nexturl = _xpath_first(tree, '//form/@action')
+        rs = _xpath_first(tree, '//input[@name="RelayState"]/@value')
+        saml = _xpath_first(tree, '//input[@name="SAMLResponse"]/@value')
         r = self._session.post(nexturl, data={'RelayState': rs,
                                               'SAMLResponse': saml})
-        if debug:
-            log('Logged in.')
-        # get sesskey
-        self.sesskey = search(r'(?<=sesskey\"\:\").*?(?=\")', r.text).group(0)
-        self.userid = search(r'(?<=data-userid\=\").*?(?=\")', r.text).group(0)
+        log('Logged in.')
+        # get sesskey (embedded in inline js, not in attributes)
+        body = r.content
+        i = body.find(b'sesskey":"')
+        j = body.find(b'data-userid="')
+        if i < 0 or j < 0:
+            raise ActionFailedError(
+                'Could not find the session key or user id after logging in.'
+                ' The mebis page layout might have changed.')
+        i += len(b'sesskey":"')
+        j += len(b'data-userid="')
+        self.sesskey = body[i:body.find(b'"', i)].decode('ascii')
+        self.userid = body[j:body.find(b'"', j)].decode('ascii')
+        self._ajax_params = {'sesskey': self.sesskey}
+        self._choice_base = {'sesskey': self.sesskey, 'action': 'makechoice'}
 
     def get(self, *args, **kwargs) -> Response:
         """Make a GET request in the context of the user's session.
@@ -124,16 +155,72 @@ class UserSession():
         """
         if debug:
             log(f'Posting ajax "{method}": {args}')
-        # TODO add documentation
+        return self.ajax_batch([(method, args)])[0]
+
+    def ajax_batch(self, calls: List[Tuple[str, dict]]) -> List[dict]:
+        """Make multiple calls to the ajax endpoint of mebis in one request.
+
+        Args:
+            calls (list, required): The calls to make, as a list of
+                `(method, args)` tuples.
+
+        Raises:
+            ActionFailedError: If any of the responses indicates an error.
+
+        Returns:
+            list: The response data of each call in json form, in the
+                order of `calls`.
+        """
+        if debug:
+            log(f'Posting ajax batch: {calls}')
         r = self.post(
-            'https://lernplattform.mebis.bayern.de/lib/ajax/service.php',
-            params={'sesskey': self.sesskey},
-            json=[{"methodname": method, "args": args}]).json()[0]
-        if r['error'] is True:
-            raise ActionFailedError(
-                'The ajax request failed. Check for spelling errors or take a'
-                + ' look at the docs.')
-        return r['data']
+            _AJAX_URL, params=self._ajax_params,
+            json=[{"index": i, "methodname": method, "args": args}
+                  for i, (method, args) in enumerate(calls)]).content
+        # moodle puts "error" first, so a failed first call needs no parsing
+        if r.startswith(b'[{"error":true'):
+            raise ActionFailedError(_AJAX_ERROR)
+        return _ajax_data(loads(r))
+
+    async def ajax_many(self, calls: List[Tuple[str, dict]]) -> List[dict]:
+        """Make multiple concurrent requests to the ajax endpoint of mebis.
+
+        Unlike :func:`ajax_batch`, every call is sent as its own request,
+        multiplexed over a single HTTP/2 connection.
+
+        Args:
+            calls (list, required): The calls to make, as a list of
+                `(method, args)` tuples.
+
+        Raises:
+            ImportError: If httpx is not installed.
+            HTTPError: If any of the requests was answered with an error.
+            ActionFailedError: If any of the responses indicates an error.
+
+        Returns:
+            list: The response data of each call in json form, in the
+                order of `calls`.
+
+        Note:
+            Requires the optional dependency httpx, install with
+            `pip install mebispy[async]`.
+        """
+        if httpx is None:
+            raise ImportError('ajax_many requires httpx. Install it with'
+                              ' "pip install mebispy[async]".')
+        if debug:
+            log(f'Posting ajax concurrently: {calls}')
+        async with httpx.AsyncClient(http2=True,
+                                     cookies=self._session.cookies,
+                                     headers=self._session.headers) as client:
+            rs = await gather(*[client.post(
+                _AJAX_URL, params=self._ajax_params,
+                json=[{"index": 0, "methodname": method, "args": args}])
+                for method, args in calls])
+        for r in rs:
+            if r.status_code >= 400:
+                raise HTTPError(r)
+        return _ajax_data([loads(r.content)[0] for r in rs])
 
     def make_survey_choice(self,
                            survey_id: Union[int, str],
@@ -153,34 +240,55 @@ class UserSession():
             log(f'Making survey choice {choice_id}'
                 + f' to survey {survey_id}...')
         try:
-            r = self._session.post('https://lernplattform.mebis.bayern.de/'
-                                   + 'mod/choice/view.php',
-                                   {'answer': choice_id,
-                                    'sesskey': self.sesskey,
-                                    'action': 'makechoice', 'id': survey_id},
+            r = self._session.post(_SURVEY_URL,
+                                   {**self._choice_base,
+                                    'answer': choice_id, 'id': survey_id},
                                    allow_redirects=False)
         except HTTPError:
-            if debug:
-                log('Making choice failed.')
+            log('Making choice failed.')
             return False
         if 'location' in r.headers:
-            if debug:
-                log('Made choice.')
+            log('Made choice.')
             return True
-        if debug:
-            log('Making choice failed.')
+        log('Making choice failed.')
         return False
 
 
-def log(msg: str):
+def _ajax_data(items: list) -> list:
+    for item in items:
+        if item['error'] is True:
+            raise ActionFailedError(_AJAX_ERROR)
+    return [item['data'] for item in items]
+
+
+def _xpath_first(tree, path: str) -> str:
+    result = tree.xpath(path)
+    if not result:
+        raise ActionFailedError(
+            f'Could not find "{path}" on the login page.'
+            ' The mebis page layout might have changed.')
+    return result[0]
+
+
+def _real_log(msg: str):
     print(f'[mebispy:DEBUG, {strftime(r"%X")}] {msg}')
 
 
+def _noop_log(msg: str):
+    pass
+
+
+log = _noop_log
+"""Function used to print debug messages.
+Swapped between a printing and a no-op version by :func:`set_debug`
+"""
+
+
 class LoginError(Exception):
     def __init__(self, username: str):
         self._username = username
         super().__init__(f'Error during login for user "{username}".'
-                         + ' Most likely the password is incorrect.')
+                         ' Most likely the password is incorrect.')
 
 
 class ActionFailedError(Exception):
@@ -188,139 +296,125 @@ class ActionFailedError(Exception):
         super().__init__(message)
 
 
+_STATUS_MESSAGES = {
+    400: 'Bad request. The server could not understand the'
+         ' request due to invalid syntax.',
+    401: 'Unauthorized. The client lacked authentication.',
+    403: 'Forbidden. The client authorized to the server but'
+         ' does not have the rights to access this resource.',
+    404: 'Not found. The requested resource could not be found'
+         ' on this server.',
+    405: 'Method not allowed. The request mothod has been disabled'
+         ' by the server. Most likely POST was used wrongly.',
+    406: 'Not acceptable. The content type set in the request'
+         ' headers can not be matched by the server.',
+    407: 'Proxy authentication required. The cllient did not'
+         ' authorize (correctly). Authorization should be done by'
+         ' a proxy.',
+    408: 'Request timeout. The connection to the server has been'
+         ' inactive for too long.',
+    409: 'Conflict. The request conflicted with the current state'
+         ' of the server.',
+    410: 'Gone. The requested resource has been deleted from the'
+         ' server.',
+    411: 'Length required. Header field "Content-Length" is'
+         ' missing.',
+    412: 'Precontidion failed. The client has indicated conditions'
+         ' in the headers, which the server does not meet.',
+    413: 'Payload too large. The request payload is too large.',
+    414: 'URI too long. The URI specified is too long for the'
+         ' server to interpret.',
+    415: 'Unsupported media type. The requested media type is not'
+         ' supported by the server.',
+    416: 'The range specified in the "Range" header field could'
+         ' not be satisfied.',
+    417: 'Expactation failed. The expectation present in the'
+         ' "Expect" header field could not be met.',
+    418: 'I´m a teapot. The server did not wish to fulfill this'
+         ' request.',
+    421: 'Misdirected request. The request was sent to a server is'
+         ' not able to create a response to your request.',
+    422: 'Unprocessable entity. The request could not be processed'
+         ' due to semantic errors.',
+    423: 'Locked. The resource you are trying to access is locked.',
+    424: 'Failed Dependency. The request failed due to failure of'
+         ' a previous request.',
+    428: 'Precondition required. The client has to indicate'
+         ' preconditions in the headers.',
+    429: 'Too many requests. The user has sent too many requests'
+         ' in a given amount of time ("rate limiting").',
+    431: 'Request header fields too large. The client has sent too'
+         'many headers.',
+    451: 'Unavailable for legal reasons. The requested resource'
+         ' cannot legally be provided, such as a web page censored by'
+         ' a government.',
+    500: 'Internal server error. The server has encountered a'
+         'situation it doesn´t know how to handle.',
+    501: 'Not implemented. The request method is not supported by'
+         ' the server and cannot be handled.',
+    502: 'Bad gateway. The server working as a gateway got a bad'
+         ' response.',
+    504: 'Gateway timeout. The server requested by the gateway did'
+         ' not respond in time.',
+    506: 'Internal configuration error.',
+    507: 'Insufficient storage. The request could not be met'
+         ' because of insufficient storage on the server side.',
+    508: 'Loop detected. The server stopped processing the request'
+         ' since it detected an infinite loop.',
+    510: 'Not extended. The request must be extended for the'
+         ' server to fulfill it.',
+    511: 'Network authentication required. The client need to'
+         ' authenticate to access the network.'
+}
+"""Messages for status codes that don't depend on the response."""
+
+_4XX = tuple(_STATUS_MESSAGES.get(c) for c in range(400, 452))
+_5XX = tuple(_STATUS_MESSAGES.get(c) for c in range(500, 512))
+"""Messages from :data:`_STATUS_MESSAGES` indexed by `code - 400` and
+`code - 500`, with `None` for unknown codes.
+"""
+
+
+@lru_cache(maxsize=1)
+def _htcpcp_anniversary(day: int) -> Union[str, None]:
+    t = date.fromordinal(day)
+    if (t.month, t.day) != (4, 1):
+        return None
+    a = str(t.year - 1998)
+    o = ('st' if a.endswith('1') else
+         'nd' if a.endswith('2') else
+         'rd' if a.endswith('3') else
+         'th')
+    return f'{a}{o}'
+
+
 class HTTPError(Exception):  # Craft more sophisticated messages.
     def __init__(self, r: Response):
         c = r.status_code
-        t = date.today()
-        a = None
-        if t.strftime(r'%d-%m') == '01-04':
-            a = str(int(t.strftime(r'%Y')) - 1998)
-            o = ('st' if a.endswith('1') else
-                 'nd' if a.endswith('2') else
-                 'rd' if a.endswith('3') else
-                 'th')
-        t = (r.headers['Retry-After'] if 'Retry-After' in r.headers
+        a = (_htcpcp_anniversary(date.today().toordinal()) if c == 418
              else None)
-        m = ('Bad request. The server could not understand the'
-             ' request due to invalid syntax.'
-             if c == 400 else
-             'Unauthorized. The client lacked authentication.'
-             if c == 401 else
-             'Forbidden. The client authorized to the server but'
-             ' does not have the rights to access this resource.'
-             if c == 403 else
-             'Not found. The requested resource could not be found'
-             ' on this server.'
-             if c == 404 else
-             'Method not allowed. The request mothod has been disabled'
-             ' by the server. Most likely POST was used wrongly.'
-             if c == 405 else
-             'Not acceptable. The content type set in the request'
-             ' headers can not be matched by the server.'
-             if c == 406 else
-             'Proxy authentication required. The cllient did not'
-             ' authorize (correctly). Authorization should be done by'
-             ' a proxy.'
-             if c == 407 else
-             'Request timeout. The connection to the server has been'
-             ' inactive for too long.'
-             if c == 408 else
-             'Conflict. The request conflicted with the current state'
-             ' of the server.'
-             if c == 409 else
-             'Gone. The requested resource has been deleted from the'
-             ' server.'
-             if c == 410 else
-             'Length required. Header field "Content-Length" is'
-             ' missing.'
-             if c == 411 else
-             'Precontidion failed. The client has indicated conditions'
-             ' in the headers, which the server does not meet.'
-             if c == 412 else
-             'Payload too large. The request payload is too large.'
-             if c == 413 else
-             'URI too long. The URI specified is too long for the'
-             ' server to interpret.'
-             if c == 414 else
-             'Unsupported media type. The requested media type is not'
-             ' supported by the server.'
-             if c == 415 else
-             'The range specified in the "Range" header field could'
-             ' not be satisfied.'
-             if c == 416 else
-             'Expactation failed. The expectation present in the'
-             ' "Expect" header field could not be met.'
-             if c == 417 else
-             'I´m a teapot. The server did not wish to fulfill this'
-             ' request.'
-             if c == 418 and not a else
-             f'I´m a teapot. Happy 1st of April and {a}{o}'
-             ' anniversary of the Hyper Text Coffee Pot Control'
-             ' Protocol!'
-             if c == 418 else
-             'Misdirected request. The request was sent to a server is'
-             ' not able to create a response to your request.'
-             if c == 421 else
-             'Unprocessable entity. The request could not be processed'
-             ' due to semantic errors.'
-             if c == 422 else
-             'Locked. The resource you are trying to access is locked.'
-             if c == 423 else
-             'Failed Dependency. The request failed due to failure of'
-             ' a previous request.'
-             if c == 424 else
-             'Upgrade required. The server refuses to perform the'
-             ' request using the current protocol but might be willing'
-             ' to do so after the client upgrades to one of these'
-             f' protocols: {r.headers["Upgrade"]}'
-             if c == 426 else
-             'Precondition required. The client has to indicate'
-             ' preconditions in the headers.'
-             if c == 428 else
-             'Too many requests. The user has sent too many requests'
-             ' in a given amount of time ("rate limiting").'
-             if c == 429 else
-             'Request header fields too large. The client has sent too'
-             'many headers.'
-             if c == 431 else
-             'Unavailable for legal reasons. The requested resource'
-             ' cannot legally be provided, such as a web page censored by'
-             ' a government.'
-             if c == 451 else
-             'Internal server error. The server has encountered a'
-             'situation it doesn´t know how to handle.'
-             if c == 500 else
-             'Not implemented. The request method is not supported by'
-             ' the server and cannot be handled.'
-             if c == 501 else
-             'Bad gateway. The server working as a gateway got a bad'
-             ' response.'
-             if c == 502 else
-             ('Service unavailable. The server is not currently able to'
-              ' respond due to maintenance, overload, etc.'
-              f' Try again after {t}.' if t else '')
-             if c == 503 else
-             'Gateway timeout. The server requested by the gateway did'
-             ' not respond in time.'
-             if c == 504 else
-             'Internal configuration error.'
-             if c == 506 else
-             'Insufficient storage. The request could not be met'
-             ' because of insufficient storage on the server side.'
-             if c == 507 else
-             'Loop detected. The server stopped processing the request'
-             ' since it detected an infinite loop.'
-             if c == 508 else
-             'Not extended. The request must be extended for the'
-             ' server to fulfill it.'
-             if c == 510 else
-             'Network authentication required. The client need to'
-             ' authenticate to access the network.'
-             if c == 511 else
-             'Unknown error.')
-        msg = f'"{r.url}" responded with: ' if debug else ''
-        msg += ('Client error,' if c < 500 else
-                'Server error,' if c < 600 else
-                'Unknown,')
-        super().__init__(f'{msg} {c}: {m} If this issue persists,'
-                         + ' please open an issue in the GitHub repository.')
+        if a:
+            m = (f'I´m a teapot. Happy 1st of April and {a}'
+                 ' anniversary of the Hyper Text Coffee Pot Control'
+                 ' Protocol!')
+        elif c == 426:
+            m = ('Upgrade required. The server refuses to perform the'
+                 ' request using the current protocol but might be willing'
+                 ' to do so after the client upgrades to one of these'
+                 f' protocols: {r.headers["Upgrade"]}')
+        elif c == 503:
+            t = (r.headers['Retry-After'] if 'Retry-After' in r.headers
+                 else None)
+            m = ('Service unavailable. The server is not currently able to'
+                 ' respond due to maintenance, overload, etc.'
+                 f' Try again after {t}.' if t else '')
+        else:
+            m = (_4XX[c - 400] if 400 <= c < 452 else
+                 _5XX[c - 500] if 500 <= c < 512 else
+                 None) or 'Unknown error.'
+        u = f'"{r.url}" responded with: ' if debug else ''
+        k = ('Client error' if c < 500 else
+             'Server error' if c < 600 else
+             'Unknown')
+        super().__init__(f'{u}{k}, {c}: {m} If this issue persists,'
+                         ' please open an issue in the GitHub repository.')
@@ -25,6 +25,11 @@ setuptools.setup(
         "Operating System :: OS Independent"
     ],
     install_requires=[
-        'requests'
-    ]
+        'requests',
+        'lxml'
+    ],
+    extras_require={
+        'speedups': ['orjson'],
+        'async': ['httpx[http2]']
+    }
 )